@@ -25,17 +25,96 @@ from eodal.core.sensors import Landsat, Sentinel2
 from eodal.mapper.filter import Filter
 
 
+# GDAL configuration options used while reading and writing
+# the data
+# - larger raster block cache (in MB)
+# - no directory listings when opening remote files
+# - caching and HTTP/2 multiplexing of remote (/vsicurl/) reads
+# - no HEAD requests before reading remote files and retries
+#   of failed requests
+# - multi-threaded decoding and encoding
+# - no PROJ network access for (transformation) grids
+GDAL_ENV: dict = {
+    'GDAL_CACHEMAX': 2048,
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'VSI_CACHE': True,
+    'VSI_CACHE_SIZE': 268435456,
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif,.TIF,.tiff,.jp2',
+    'CPL_VSIL_CURL_USE_HEAD': 'NO',
+    'GDAL_HTTP_MULTIPLEX': 'YES',
+    'GDAL_HTTP_VERSION': 2,
+    'GDAL_HTTP_MAX_RETRY': 3,
+    'GDAL_HTTP_RETRY_DELAY': 1,
+    'GDAL_NUM_THREADS': 'ALL_CPUS',
+    'PROJ_NETWORK': 'OFF',
+}
+
+# creation options of the cloud-optimized GeoTIFFs written
+# - tiled with 512x512 pixel blocks
+# - ZSTD compression (fast level) with horizontal differencing
+#   as predictor (all outputs are integer data)
+# - multi-threaded compression
+COG_PROFILE: dict = {
+    'driver': 'GTiff',
+    'interleave': 'pixel',
+    'tiled': True,
+    'blockxsize': 512,
+    'blockysize': 512,
+    'compress': 'ZSTD',
+    'zstd_level': 1,
+    'predictor': 2,
+    'num_threads': 'ALL_CPUS',
+    'bigtiff': 'IF_SAFER',
+}
+
+# creation options per output. The cloud mask is binary so that
+# it is stored with one bit per pixel. Horizontal differencing is
+# not supported by libtiff for 1-bit samples
+COG_PROFILES: dict[str, dict] = {
+    'rgb': COG_PROFILE,
+    'fcir': COG_PROFILE,
+    'ndvi': COG_PROFILE,
+    'cloud_mask': {**COG_PROFILE, 'predictor': 1, 'nbits': 1},
+}
+
+# GDAL configuration options used while writing the
+# cloud-optimized GeoTIFFs (incl. their internal overviews).
+# The options are entered by the thread writing a file as
+# GDAL configuration options set by rasterio are thread-local
+COG_ENV: dict = {
+    'GDAL_CACHEMAX': 512,
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'GDAL_NUM_THREADS': 'ALL_CPUS',
+    'GDAL_TIFF_OVR_BLOCKSIZE': 512,
+}
+
+# query results in the STAC cache not used for this number of days
+# are removed from the cache
+STAC_CACHE_MAX_AGE_DAYS: int = 30
+
+
 def preprocess_sentinel2_scenes(
     ds: Sentinel2,
 ) -> Sentinel2:
     """
     Resample Sentinel-2 scenes to a spatial resolution of 10 m.
+    Bands already at 10 m (e.g., B02, B03, B04 and B08) are not
+    touched.
 
     :returns:
         resampled Sentinel-2 scene (10 m spatial resolution).
     """
-    # resample scene
-    ds.resample(inplace=True, target_resolution=10)
+    # resample only bands not at the target resolution (e.g., SCL)
+    band_selection = [
+        band_name for band_name in ds.band_names
+        if ds[band_name].geo_info.pixres_x != 10
+    ]
+    if band_selection:
+        ds.resample(
+            band_selection=band_selection,
+            inplace=True,
+            target_resolution=10
+        )
     return ds
 
 
@@ -43,7 +122,10 @@ class Constants:
     """
     Constants for the eodal_viewer package.
     """
-    pass
+    # bands written to the RGB and FCIR (false color infra-red) outputs
+    # (defaults for subclasses not setting them)
+    RGB_BANDS: tuple[str, ...] = ('red', 'green', 'blue')
+    FCIR_BANDS: tuple[str, ...] = ('nir_1', 'red', 'green')
 
 
 class LandsatC2L1Constants(Constants):
@@ -70,6 +152,11 @@ class LandsatC2L1Constants(Constants):
             'apply_scaling': False},
     }
 
+    # bands written to the RGB and FCIR (false color infra-red) outputs
+    # (no RGB for Landsat 1-4 as they do not have a blue band)
+    RGB_BANDS: tuple[str, ...] = ()
+    FCIR_BANDS: tuple[str, ...] = ('nir08', 'red', 'green')
+
     # start date of the time period to query if no time period
     # is specified
     START_DATE: datetime = datetime(1972, 9, 1)
@@ -99,6 +186,10 @@ class LandsatC2L2Constants(Constants):
             'apply_scaling': False},
     }
 
+    # bands written to the RGB and FCIR (false color infra-red) outputs
+    RGB_BANDS: tuple[str, ...] = ('red', 'green', 'blue')
+    FCIR_BANDS: tuple[str, ...] = ('nir08', 'red', 'green')
+
     # start date of the time period to query if no time period
     # is specified
     START_DATE: datetime = datetime(2016, 1, 1)
@@ -130,6 +221,10 @@ class Sentinel2Constants(Constants):
         'scene_modifier': preprocess_sentinel2_scenes
     }
 
+    # bands written to the RGB and FCIR (false color infra-red) outputs
+    RGB_BANDS: tuple[str, ...] = ('red', 'green', 'blue')
+    FCIR_BANDS: tuple[str, ...] = ('nir_1', 'red', 'green')
+
     # start date of the time period to query if no time period
     # is specified
     START_DATE: datetime = datetime(2017, 1, 1)
@@ -24,49 +24,65 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import annotations
 
 import argparse
-import geopandas as gpd
+import multiprocessing
+import os
+import rasterio as rio
 import warnings
 
+from collections import deque
+from concurrent.futures import (
+    as_completed,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from copy import deepcopy
 from datetime import datetime, timedelta
-from eodal.core.sensors import Landsat, Sentinel2
+from eodal.core.raster import RasterCollection
 from eodal.mapper.feature import Feature
 from eodal.mapper.mapper import Mapper, MapperConfigs
 from eodal.config import get_settings
 from pathlib import Path
+from typing import Callable
 
 from eodal_basetiffs.constants import (
     Constants,
+    COG_PROFILES,
+    GDAL_ENV,
     Sentinel2Constants,
     LandsatC2L1Constants,
     LandsatC2L2Constants,
 )
 from eodal_basetiffs.utils import (
+    calc_cloudy_pixel_percentage,
+    filter_processed_scenes,
+    get_gdal_env,
     get_latest_scene,
     indicate_complete,
     make_output_dir_scene,
     post_process_scene,
-    scale_ndvi,
+    query_scenes,
+    read_feature,
     set_latest_scene,
     SceneProcessedException,
     write_cloudy_pixel_percentage,
+    write_cog,
     write_scene_metadata,
 )
 
 
-# setup logging and usage of STAC API for data access
+# setup logging
 settings = get_settings()
-settings.USE_STAC = True
 logger = settings.logger
 
-# ignore warnings
-warnings.filterwarnings("ignore")
-
 
 def fetch_data(
     output_dir: Path,
     mapper_configs: MapperConfigs,
     constants: Constants,
     target_crs: int,
+    n_workers: int = 1,
+    max_cloudy_pixel_percentage: float | None = None,
 ) -> None:
     """
     Fetch satellite data for a given time period and geographic extent
@@ -78,11 +94,26 @@ def fetch_data(
     :param mapper_configs: MapperConfigs object
     :param constants: Constants object containing the scene kwargs
     :param target_crs: target CRS for reprojection as EPSG code
+    :param n_workers: number of processes to use for post-processing
+        and writing the scenes. If 1 (default), the scenes are processed
+        sequentially in the current process. If 0 or smaller, half of
+        the available CPUs are used.
+    :param max_cloudy_pixel_percentage: scenes with a higher cloudy
+        pixel percentage are not post-processed and no GeoTIFFs are
+        written for them. If None (default), all scenes are processed.
     """
+    # use the STAC API for data access. This is set here and not
+    # at import time to leave the EOdal settings of applications
+    # importing this module untouched
+    settings.USE_STAC = True
+
     # create the Mapper object
     mapper = Mapper(mapper_configs)
-    # query metadata to identify available scenes
-    mapper.query_scenes()
+    # query metadata to identify available scenes. The query results
+    # are cached in the output directory
+    query_scenes(mapper, cache_dir=output_dir.joinpath(".stac_cache"))
+    # scenes processed in a previous run are not downloaded again
+    filter_processed_scenes(mapper, output_dir=output_dir)
     # check if scenes are available
     if mapper.metadata.empty:
         # if there are no scenes we must fake the folder
@@ -96,100 +127,292 @@ def fetch_data(
         )
         return
 
-    # load the data. This is the actual download step
-    mapper.load_scenes(scene_kwargs=constants.SCENE_KWARGS)
+    # load the data. This is the actual download step.
+    # EOdal updates the scene constructor kwargs in place, therefore,
+    # a copy is passed to keep the class attributes of the constants
+    # unchanged between calls
+    # Warnings raised by the underlying libraries while reading the
+    # data are not of interest here
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        mapper.load_scenes(scene_kwargs=deepcopy(constants.SCENE_KWARGS))
 
     # Loop over the scenes in the collection.
     # Each scene is stored in a separate sub-directory named by
-    # the time stamp of the scene. For each scene, four files
-    # are created and stored as GeoTIFFs:
-    # - RGB image (red, green, blue; not for Landsat 1-4)
-    # - cloud mask (binary)
-    # - FCIR image (false color infra-red, i.e., nir, red, green)
-    # - NDVI image (normalized difference vegetation index)
-    for timestamp, scene in mapper.data:
-        # create the output directory
-        try:
-            output_dir_scene = make_output_dir_scene(
-                output_dir=output_dir, timestamp=timestamp
+    # the time stamp of the scene. Scenes are independent of each
+    # other and are, therefore, processed in parallel if n_workers > 1.
+    # The `latest_scene` file is updated in chronological order as soon
+    # as a scene and all scenes before it have been handled.
+    # The workers are started with the "spawn" method so that they do
+    # not inherit GDAL state (open datasets, caches) from this process.
+    # The CPUs are split among the workers to avoid oversubscription.
+    # More workers than scenes are never started.
+    if n_workers <= 0:
+        n_workers = max(1, (os.cpu_count() or 1) // 2)
+    n_workers = max(1, min(n_workers, len(mapper.data.collection)))
+    num_threads = max(1, (os.cpu_count() or 1) // n_workers)
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(num_threads,),
+        )
+        submit = executor.submit
+    else:
+        executor = None
+        submit = _run_inline
+
+    jobs = deque()
+    scoll = mapper.data
+    try:
+        # scenes are removed from the collection once they are handed
+        # over for processing so that their data can be released as
+        # soon as they have been written
+        for timestamp in list(scoll.collection.keys()):
+            scene = scoll[timestamp]
+            del scoll[timestamp]
+            # create the output directory
+            try:
+                output_dir_scene = make_output_dir_scene(
+                    output_dir=output_dir, timestamp=timestamp
+                )
+            except SceneProcessedException as e:
+                logger.info(e)
+                # increase the time stamp to the last processed scene
+                # and continue
+                jobs.append((timestamp, None, None))
+            else:
+                future = submit(
+                    process_scene,
+                    timestamp=timestamp,
+                    scene=scene,
+                    output_dir_scene=output_dir_scene,
+                    target_crs=target_crs,
+                    constants=constants,
+                    num_threads=num_threads,
+                    max_cloudy_pixel_percentage=max_cloudy_pixel_percentage,
+                )
+                jobs.append((timestamp, output_dir_scene, future))
+            del scene
+
+            # finalize all scenes at the head of the queue that are done
+            while jobs and (jobs[0][2] is None or jobs[0][2].done()):
+                _finalize_scene(output_dir, *jobs.popleft())
+
+        # wait for the remaining scenes
+        while jobs:
+            _finalize_scene(output_dir, *jobs.popleft())
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def process_scene(
+    timestamp: datetime,
+    scene: RasterCollection,
+    output_dir_scene: Path,
+    target_crs: int,
+    constants: Constants,
+    num_threads: int = os.cpu_count() or 1,
+    max_cloudy_pixel_percentage: float | None = None,
+) -> bool:
+    """
+    Post-process a single scene and write the outputs to its
+    sub-directory. For each scene, four files are created and
+    stored as GeoTIFFs:
+    - RGB image (red, green, blue; not for Landsat 1-4)
+    - cloud mask (binary)
+    - FCIR image (false color infra-red, i.e., nir, red, green)
+    - NDVI image (normalized difference vegetation index)
+
+    The function is called in a separate process when scenes
+    are processed in parallel.
+
+    :param timestamp: time stamp of the scene
+    :param scene: scene to process
+    :param output_dir_scene: output directory of the scene
+    :param target_crs: target CRS for reprojection as EPSG code
+    :param constants: Constants object defining the bands of the outputs
+    :param num_threads: number of threads used for reprojection
+        and writing the outputs
+    :param max_cloudy_pixel_percentage: if the cloudy pixel percentage
+        of the scene is higher, only the cloudy pixel percentage and
+        the metadata are written
+    :returns:
+        True if the scene was processed successfully, False if
+        the post-processing failed.
+    """
+    # the output files are prefixed with the date of the scene
+    date_str = timestamp.date().isoformat()
+    fpath_cloudy_pixel_percentage = (
+        output_dir_scene / f"{date_str}_cloudy_pixel_percentage.txt")
+    fpath_metadata = output_dir_scene / f"{date_str}_metadata.yaml"
+
+    # skip scenes that are too cloudy before the expensive
+    # post-processing. The cloudy pixel percentage is calculated
+    # on the scene in its original CRS
+    if max_cloudy_pixel_percentage is not None:
+        cloudy_pixel_percentage = calc_cloudy_pixel_percentage(scene)
+        if cloudy_pixel_percentage is not None and \
+                cloudy_pixel_percentage > max_cloudy_pixel_percentage:
+            logger.info(
+                f"Scene {date_str} is too cloudy " +
+                f"({cloudy_pixel_percentage:.1f}%) -> no GeoTIFFs written")
+            write_cloudy_pixel_percentage(
+                scene,
+                fpath_cloudy_pixel_percentage,
+                cloudy_pixel_percentage=cloudy_pixel_percentage
             )
-        except SceneProcessedException as e:
-            logger.info(e)
-            # increase the time stamp to the last processed scene
-            # and continue
-            set_latest_scene(output_dir, timestamp=timestamp)
-            continue
-
-        # post-process the scene
-        # This means:
-        # - reprojection to target CRS
-        # - calculation of the NDVI
-        # - generation of a binary cloud mask from the Scene
-        try:
-            scene = post_process_scene(scene, target_crs=target_crs)
-        except Exception as e:
-            logger.error(f"Error while post-processing scene: {e}")
-            continue
-
-        # save the RGB bands as GeoTIFF. This is not possible
-        # for Landsat 1-4 as they do not have a blue band.
-        if "blue" in scene.band_names or "blue" in scene.band_aliases:
-            fpath_rgb = output_dir_scene.joinpath(
-                f"{timestamp.date()}_rgb.tif")
-            scene.to_rasterio(
-                band_selection=["red", "green", "blue"],
-                fpath_raster=fpath_rgb,
-                as_cog=True,
+            write_scene_metadata(scene, fpath_metadata)
+            return True
+
+    # post-process the scene
+    # This means:
+    # - reprojection to target CRS
+    # - calculation of the NDVI (scaled to UINT16)
+    # - generation of a binary cloud mask from the Scene
+    try:
+        scene = post_process_scene(
+            scene, target_crs=target_crs, num_threads=num_threads)
+    except Exception as e:
+        logger.error(f"Error while post-processing scene: {e}")
+        return False
+
+    # collect the GeoTIFFs to write
+    writes = []
+    # save the RGB bands as GeoTIFF. This is not possible
+    # for Landsat 1-4 as they do not have a blue band.
+    if constants.RGB_BANDS:
+        fpath_rgb = output_dir_scene / f"{date_str}_rgb.tif"
+        writes.append({
+            "band_selection": list(constants.RGB_BANDS),
+            "fpath_raster": fpath_rgb,
+            "profile": COG_PROFILES["rgb"],
+        })
+
+    # save the cloud mask as GeoTIFF
+    fpath_cloud_mask = output_dir_scene / f"{date_str}_cloud_mask.tif"
+    writes.append({
+        "band_selection": ["cloud_mask"],
+        "fpath_raster": fpath_cloud_mask,
+        "profile": COG_PROFILES["cloud_mask"],
+        "overview_resampling": "nearest",
+    })
+
+    # save the FCIR bands as GeoTIFF
+    fpath_fcir = output_dir_scene / f"{date_str}_fcir.tif"
+    # the naming of the nir band is different for Landsat
+    # and Sentinel-2 and is, therefore, taken from the constants
+    writes.append({
+        "band_selection": list(constants.FCIR_BANDS),
+        "fpath_raster": fpath_fcir,
+        "profile": COG_PROFILES["fcir"],
+    })
+
+    # save the NDVI as GeoTIFF
+    fpath_ndvi = output_dir_scene / f"{date_str}_ndvi.tif"
+    writes.append({
+        "band_selection": ["ndvi"],
+        "fpath_raster": fpath_ndvi,
+        "profile": COG_PROFILES["ndvi"],
+    })
+
+    # outputs in web mercator are aligned to the tiling scheme used
+    # by tile servers
+    web_optimized = target_crs == 3857
+
+    # the GeoTIFFs are independent of each other and GDAL releases
+    # the GIL while encoding so they are written in parallel threads.
+    # The threads available to the scene are split among the writers.
+    # Warnings raised while writing are ignored
+    n_writers = max(1, min(len(writes), num_threads))
+    num_threads_writer = max(1, num_threads // n_writers)
+    with warnings.catch_warnings(), ThreadPoolExecutor(
+        max_workers=n_writers
+    ) as executor:
+        warnings.simplefilter("ignore")
+        futures = [
+            executor.submit(
+                write_cog,
+                scene,
+                web_optimized=web_optimized,
+                num_threads=num_threads_writer,
+                **kwargs
             )
+            for kwargs in writes
+        ]
+        for future in as_completed(futures):
+            # raise errors that occurred while writing
+            future.result()
 
-        # save the cloud mask as GeoTIFF
-        fpath_cloud_mask = output_dir_scene.joinpath(
-            f"{timestamp.date()}_cloud_mask.tif"
-        )
-        scene.to_rasterio(
-            band_selection=["cloud_mask"],
-            fpath_raster=fpath_cloud_mask,
-            as_cog=True
-        )
+    # write the cloudy pixel percentage to disk
+    write_cloudy_pixel_percentage(scene, fpath_cloudy_pixel_percentage)
 
-        # save the FCIR bands as GeoTIFF
-        fpath_fcir = output_dir_scene.joinpath(f"{timestamp.date()}_fcir.tif")
-        # the naming of the nir band is different for Landsat
-        # and Sentinel-2
-        if isinstance(scene, Sentinel2):
-            band_selection = ["nir_1", "red", "green"]
-        elif isinstance(scene, Landsat):
-            band_selection = ["nir08", "red", "green"]
-        scene.to_rasterio(
-            band_selection=band_selection, fpath_raster=fpath_fcir, as_cog=True
-        )
+    # write the scene metadata to disk
+    write_scene_metadata(scene, fpath_metadata)
 
-        # save the NDVI as GeoTIFF
-        fpath_ndvi = output_dir_scene.joinpath(f"{timestamp.date()}_ndvi.tif")
-        # calculate the scaled NDVI
-        scale_ndvi(scene)
+    return True
 
-        scene.to_rasterio(
-            band_selection=["ndvi"],
-            fpath_raster=fpath_ndvi,
-            as_cog=True)
 
-        # write the cloudy pixel percentage to disk
-        fpath_cloudy_pixel_percentage = output_dir_scene.joinpath(
-            f"{timestamp.date()}_cloudy_pixel_percentage.txt"
-        )
-        write_cloudy_pixel_percentage(scene, fpath_cloudy_pixel_percentage)
+def _init_worker(num_threads: int) -> None:
+    """
+    Initialize a worker process used for processing scenes.
 
-        # write the scene metadata to disk
-        fpath_metadata = output_dir_scene.joinpath(
-            f"{timestamp.date()}_metadata.yaml")
-        write_scene_metadata(scene, fpath_metadata)
+    The GDAL configuration of the main process is not shared with
+    the workers. Therefore, it is passed as environment variables
+    (which GDAL uses as fallback for its configuration options) with
+    the number of threads limited to the CPUs assigned to the worker.
+    The limit overrides `GDAL_NUM_THREADS` set as environment variable
+    (see `get_gdal_env`).
+
+    :param num_threads: number of threads GDAL may use in the worker
+    """
+    gdal_env = {**get_gdal_env(GDAL_ENV), "GDAL_NUM_THREADS": num_threads}
+    for key, value in gdal_env.items():
+        os.environ[key] = str(value)
 
-        # write a file termed "complete" to disk to indicate
-        # that the scene has been processed successfully
-        set_latest_scene(output_dir, timestamp=timestamp)
-        indicate_complete(output_dir_scene)
 
+def _run_inline(func: Callable, *args, **kwargs) -> Future:
+    """
+    Run a function in the current process and wrap its result
+    into a `Future` so that it can be handled like a function
+    submitted to an executor.
+    """
+    future = Future()
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def _finalize_scene(
+    output_dir: Path,
+    timestamp: datetime,
+    output_dir_scene: Path | None,
+    future: Future | None,
+) -> None:
+    """
+    Finalize a scene once it has been processed. Scenes that have
+    been skipped because they were already processed have no
+    `Future` attached.
+
+    :param output_dir: output directory where the data is stored
+    :param timestamp: time stamp of the scene
+    :param output_dir_scene: output directory of the scene
+    :param future: `Future` of the call to `process_scene`
+    """
+    if future is not None:
+        # errors while writing the data are propagated to the caller
+        if not future.result():
+            return
+
+    # write a file termed "complete" to disk to indicate
+    # that the scene has been processed successfully
+    set_latest_scene(output_dir, timestamp=timestamp)
+    if future is not None:
+        indicate_complete(output_dir_scene)
         logger.info(f"Processed scene {timestamp.date()}")
 
 
@@ -200,6 +423,8 @@ def monitor_folder(
     temporal_increment_days: int = 7,
     target_crs: int = 3857,
     run_till_complete: bool = False,
+    n_workers: int = 1,
+    max_cloudy_pixel_percentage: float | None = None,
 ) -> None:
     """
     Monitor a folder with satellite scenes and fetch new data
@@ -231,55 +456,78 @@ def monitor_folder(
         and no new data is available (i.e., the last processed scene
         is the last scene available and all other scenes would be in the
         future).
+    :param n_workers:
+        number of processes to use for post-processing and writing
+        the scenes. If 1 (default), the scenes are processed
+        sequentially. If 0 or smaller, half of the available CPUs
+        are used.
+    :param max_cloudy_pixel_percentage:
+        scenes with a higher cloudy pixel percentage in the area of
+        interest are not post-processed and no GeoTIFFs are written
+        (Sentinel-2 only). If None (default), all scenes are processed.
     """
-    # get the latest scene to determine the start date
-    last_processed_scene = get_latest_scene(
-        folder_to_monitor,
-        constants=constants)
-    time_start = last_processed_scene + timedelta(days=1)
-
-    # if time start is in the future, there is nothing to do
-    if time_start > datetime.now():
-        logger.info(
-            f"Start date {time_start.date()} is in the future. Exiting.")
-        return
-
-    # the end time for the next query will be the time stamp of the
-    # last processed scene plus the temporal increment
-    time_end = time_start + timedelta(days=temporal_increment_days)
-
-    # setup the Mapper
-    mapper_configs = MapperConfigs(
-        collection=constants.COLLECTION,
-        time_start=time_start,
-        time_end=time_end,
-        metadata_filters=constants.METADATA_FILTERS,
-        feature=feature,
-    )
-
-    # fetch data
-    try:
-        fetch_data(
+    # the scenes are fetched in temporal increments. If
+    # run_till_complete is True, the loop continues until all
+    # scenes are processed
+    while True:
+        # get the latest scene to determine the start date
+        last_processed_scene = get_latest_scene(
             folder_to_monitor,
-            mapper_configs,
-            target_crs=target_crs,
-            constants=constants,
+            constants=constants)
+        time_start = last_processed_scene + timedelta(days=1)
+
+        # if time start is in the future, there is nothing to do
+        if time_start > datetime.now():
+            logger.info(
+                f"Start date {time_start.date()} is in the future. Exiting.")
+            return
+
+        # the end time for the next query will be the time stamp of the
+        # last processed scene plus the temporal increment (but not
+        # later than now)
+        time_end = min(
+            time_start + timedelta(days=temporal_increment_days),
+            datetime.now()
         )
-    except Exception as e:
-        logger.error(f"Error while fetching data: {e}")
 
-    # if run_till_complete is True, we call the function recursively
-    # until all scenes are processed
-    if run_till_complete:
-        monitor_folder(
-            folder_to_monitor=folder_to_monitor,
+        # setup the Mapper
+        mapper_configs = MapperConfigs(
+            collection=constants.COLLECTION,
+            time_start=time_start,
+            time_end=time_end,
+            metadata_filters=constants.METADATA_FILTERS,
             feature=feature,
-            constants=constants,
-            temporal_increment_days=temporal_increment_days,
-            target_crs=target_crs,
-            run_till_complete=run_till_complete,
         )
 
+        # fetch data. All reads and writes share the same GDAL
+        # configuration
+        try:
+            with rio.Env(**get_gdal_env(GDAL_ENV)):
+                fetch_data(
+                    folder_to_monitor,
+                    mapper_configs,
+                    target_crs=target_crs,
+                    constants=constants,
+                    n_workers=n_workers,
+                    max_cloudy_pixel_percentage=max_cloudy_pixel_percentage,
+                )
+        except Exception as e:
+            logger.error(f"Error while fetching data: {e}")
+
+        if not run_till_complete:
+            return
+
+        # stop if the latest scene did not advance (e.g., because
+        # fetching the data or processing a scene failed). Otherwise,
+        # the same time period would be queried over and over again
+        if get_latest_scene(
+                folder_to_monitor,
+                constants=constants) == last_processed_scene:
+            logger.error(
+                "No progress after " +
+                f"{last_processed_scene.date()} -> stopping")
+            return
+
 
 def cli() -> None:
     """
@@ -332,6 +580,22 @@ def cli() -> None:
         default="False",
         help="run the script till all available scenes have been downloaded?"
     )
+    parser.add_argument(
+        "-n",
+        "--n-workers",
+        type=int,
+        default=1,
+        help="number of processes to use for processing the scenes "
+        + "(0 to use half of the available CPUs)",
+    )
+    parser.add_argument(
+        "-m",
+        "--max-cloudy-pixel-percentage",
+        type=float,
+        default=None,
+        help="do not write GeoTIFFs for scenes with a higher cloudy "
+        + "pixel percentage (Sentinel-2 only)",
+    )
 
     # parse the CLI arguments
     args = parser.parse_args()
@@ -359,8 +623,7 @@ def cli() -> None:
     fpath_feature = Path(args.area_of_interest)
     if not fpath_feature.exists():
         raise FileNotFoundError(f"{fpath_feature} does not exist")
-    feature = Feature.from_geoseries(
-        gpd.read_file(fpath_feature).dissolve().geometry)
+    feature = read_feature(fpath_feature)
 
     # run till complete evaluation
     if args.run_till_complete.lower() == 'false':
@@ -378,6 +641,8 @@ def cli() -> None:
         temporal_increment_days=args.temporal_increment_days,
         target_crs=args.target_crs,
         run_till_complete=run_till_complete,
+        n_workers=args.n_workers,
+        max_cloudy_pixel_percentage=args.max_cloudy_pixel_percentage,
     )
 
 
@@ -24,22 +24,249 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import annotations
 
 import eodal
+import geopandas as gpd
+import hashlib
 import numpy as np
+import os
+import pandas as pd
+import pyogrio
+import time
 import yaml
 
-from datetime import datetime
-from eodal.core.band import Band
+from affine import Affine
+from copy import deepcopy
+from datetime import date, datetime
+from eodal.core.band import Band, GeoInfo
 from eodal.core.raster import RasterCollection
 from eodal.core.sensors import Landsat, Sentinel2
+from eodal.core.utils import get_highest_dtype
+from eodal.mapper.feature import Feature
+from eodal.mapper.mapper import Mapper
+from functools import lru_cache
 from pathlib import Path
+from rasterio import Env
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.transform import array_bounds
+from rasterio.warp import calculate_default_transform, reproject
+from rio_cogeo.cogeo import cog_translate
+from shapely.ops import unary_union
 
-from eodal_basetiffs.constants import Constants
+from eodal_basetiffs.constants import (
+    Constants, COG_ENV, COG_PROFILE, STAC_CACHE_MAX_AGE_DAYS)
+
+# use the C implementation of the YAML dumper (libyaml) if available
+try:
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
+
+
+# version of EOdal written to the scene metadata
+_EODAL_VERSION = eodal.__version__
+
+# lookup table marking the Sentinel-2 Scene Classification Layer (SCL)
+# classes treated as clouds (1) in the cloud mask (see post_process_scene)
+_S2_CLOUD_LUT = np.zeros(256, dtype=np.uint8)
+_S2_CLOUD_LUT[[3, 8, 9]] = 1
 
 
 class SceneProcessedException(Exception):
     pass
 
 
+def calc_cloudy_pixel_percentage(scene: RasterCollection) -> float | None:
+    """
+    Calculate the percentage of cloudy pixels in a satellite scene.
+
+    Same as `scene.get_cloudy_pixel_percentage(cloud_classes=[3, 8, 9])`
+    for Sentinel-2. If the scene has been post-processed, the cloudy
+    pixels are counted in its cloud mask instead of classifying the SCL
+    again. Pixels outside of the area of interest and nodata pixels
+    (SCL class 0) are not taken into account.
+
+    :param scene:
+        satellite scene
+    :returns:
+        cloudy pixel percentage [0-100] or None if it is not
+        available for the scene (Landsat).
+    """
+    if not isinstance(scene, Sentinel2):
+        return None
+
+    # The pixels are counted without building intermediate
+    # boolean arrays of the size of the scene
+    scl = scene['SCL'].values
+    scl_data = np.ma.getdata(scl)
+    scl_mask = np.ma.getmask(scl)
+    n_valid = np.count_nonzero(scl_data)
+    if scl_mask is not np.ma.nomask:
+        n_valid -= np.count_nonzero(scl_data[scl_mask])
+
+    if 'cloud_mask' in scene.band_names:
+        n_cloudy = np.count_nonzero(scene['cloud_mask'].values)
+    else:
+        # the SCL classes are cast to uint8 to index the lookup table
+        # (as for the cloud mask in `post_process_scene`)
+        scl_classes = scl_data.astype(np.uint8, copy=False)
+        n_cloudy = np.count_nonzero(_S2_CLOUD_LUT[scl_classes])
+        if scl_mask is not np.ma.nomask:
+            n_cloudy -= np.count_nonzero(
+                _S2_CLOUD_LUT[scl_classes[scl_mask]])
+
+    return n_cloudy / n_valid * 100 if n_valid > 0 else np.nan
+
+
+def calc_ndvi(scene: RasterCollection) -> None:
+    """
+    Calculate the Normalized Difference Vegetation Index (NDVI)
+    and add it to the scene as UINT16 band 'ndvi'.
+
+    The NDVI is calculated in single precision in blocks of rows
+    matching the block size of the output files so that the floating
+    point intermediates only take a few MB. It is clipped to [-1, 1],
+    scaled by 10000 and offset by 10000 (i.e., scale 0.0001 and offset
+    -1 to obtain the original NDVI) and rounded to the next integer.
+    Pixels without a valid NDVI (masked or zero denominator) are set
+    to the nodata value 21000. The NDVI is, thus, never added to the
+    scene as floating point band.
+
+    :param scene:
+        satellite scene
+    """
+    # the naming of the nir band is different for Landsat
+    # and Sentinel-2
+    nir_band = 'nir_1' if isinstance(scene, Sentinel2) else 'nir08'
+    red_band = scene['red']
+    red = red_band.values
+    nir = scene[nir_band].values
+    is_masked = np.ma.isMaskedArray(red) or np.ma.isMaskedArray(nir)
+    red_data = np.ma.getdata(red)
+    nir_data = np.ma.getdata(nir)
+    if is_masked:
+        masked = np.ma.getmaskarray(red) | np.ma.getmaskarray(nir)
+
+    ndvi_uint16 = np.empty(red.shape, dtype=np.uint16)
+    block_rows = COG_PROFILE['blockysize']
+    for row in range(0, red.shape[0], block_rows):
+        rows = slice(row, row + block_rows)
+        # NDVI = (nir - red) / (nir + red)
+        red_block = red_data[rows].astype(np.float32)
+        ndvi = nir_data[rows].astype(np.float32)
+        denominator = ndvi + red_block
+        np.subtract(ndvi, red_block, out=ndvi)
+        invalid = denominator == 0
+        np.divide(ndvi, denominator, out=ndvi, where=~invalid)
+        if is_masked:
+            invalid |= masked[rows]
+
+        # scale to uint16 in the same buffer
+        ndvi *= 10000
+        np.clip(ndvi, -10000, 10000, out=ndvi)
+        ndvi += 10000
+        ndvi[invalid] = 21000
+        # round and cast to uint16 in a single pass
+        np.rint(ndvi, out=ndvi_uint16[rows], casting='unsafe')
+
+    if is_masked:
+        # valid NDVI values never exceed 20000
+        ndvi_uint16 = np.ma.MaskedArray(
+            data=ndvi_uint16, mask=ndvi_uint16 == 21000)
+
+    scene.add_band(
+        band_constructor=Band,
+        band_name='ndvi',
+        values=ndvi_uint16,
+        nodata=21000,
+        scale=0.0001,
+        offset=-1,
+        geo_info=red_band.geo_info
+    )
+
+
+def filter_processed_scenes(mapper: Mapper, output_dir: Path) -> None:
+    """
+    Remove scenes that have been processed already from the metadata
+    of a `Mapper` (in place) so that they are not loaded again.
+
+    A scene counts as processed if its sub-directory in the output
+    directory (named by the sensing date) contains the `complete.txt`
+    file written by `indicate_complete`.
+
+    :param mapper:
+        Mapper with the queried scene metadata
+    :param output_dir:
+        directory where scenes are stored (in sub-directories)
+    """
+    # nothing to filter if no scenes were found. The metadata
+    # has no columns in this case
+    metadata = mapper.metadata
+    if metadata is None or metadata.empty:
+        return
+
+    # list the sub-directories of processed scenes once
+    with os.scandir(output_dir) as it:
+        processed = {
+            entry.name for entry in it
+            if entry.is_dir() and
+            os.path.exists(os.path.join(entry.path, 'complete.txt'))
+        }
+    if not processed:
+        return
+
+    sensing_dates = pd.to_datetime(
+        metadata['sensing_time']).dt.date.astype(str)
+    is_processed = sensing_dates.isin(processed)
+    if is_processed.any():
+        mapper.metadata = metadata[~is_processed.values].copy()
+
+
+@lru_cache(maxsize=None)
+def get_crs(epsg: int) -> CRS:
+    """
+    Get a coordinate reference system from its EPSG code.
+
+    The CRS objects are cached so that the lookup in the PROJ
+    database is done only once per EPSG code and process and
+    not for every band and scene reprojected.
+
+    :param epsg:
+        EPSG code
+    :returns:
+        `rasterio` CRS object
+    """
+    return CRS.from_epsg(epsg)
+
+
+def get_gdal_env(defaults: dict) -> dict:
+    """
+    Get GDAL configuration options from a set of defaults.
+
+    Options set as environment variables take precedence over
+    the defaults so that they can be tuned without changing the
+    code. As GDAL configuration options set by rasterio override
+    environment variables, these options are dropped from the
+    returned configuration.
+
+    The only exception is `GDAL_NUM_THREADS`: when scenes are
+    processed in parallel, the number of threads is limited per
+    worker process (`main._init_worker`) and per output file
+    (`write_cog(num_threads=...)`) so that the CPUs are not
+    oversubscribed. These limits override `GDAL_NUM_THREADS` set
+    as environment variable.
+
+    :param defaults:
+        default GDAL configuration options
+    :returns:
+        GDAL configuration options not set as environment variables
+    """
+    return {
+        key: value for key, value in defaults.items()
+        if key not in os.environ
+    }
+
+
 def get_latest_scene(output_dir: Path, constants: Constants) -> datetime:
     """
     Get the timestamp of the latest scene from a
@@ -51,15 +278,51 @@ def get_latest_scene(output_dir: Path, constants: Constants) -> datetime:
     :param constants:
         constants object
     """
-    fpath_latest_scene = output_dir.joinpath('latest_scene')
-    if fpath_latest_scene.exists():
-        with open(output_dir.joinpath('latest_scene'), 'r') as f:
-            timestamp_raw = f.read()
-        timestamp_raw = timestamp_raw.replace('\n', '')
-        timestamp = datetime.strptime(timestamp_raw, '%Y-%m-%d')
-    else:
-        timestamp = constants.START_DATE
-    return timestamp
+    # the file is read directly instead of checking its existence
+    # first (no directory listing or additional stat call)
+    try:
+        timestamp_raw = output_dir.joinpath('latest_scene').read_text()
+    except FileNotFoundError:
+        return constants.START_DATE
+    # the date is stored in ISO format (YYYY-MM-DD)
+    return datetime.fromisoformat(timestamp_raw.strip())
+
+
+@lru_cache(maxsize=32)
+def get_target_grid(
+    src_epsg: int,
+    target_crs: int,
+    ncols: int,
+    nrows: int,
+    src_transform: Affine
+) -> tuple[Affine, int, int]:
+    """
+    Get the grid of a raster reprojected into a target CRS.
+
+    The bands of a scene (and scenes of the same tile) usually share
+    the same grid so that the grid is cached instead of being derived
+    by PROJ for every band.
+
+    :param src_epsg:
+        EPSG code of the source CRS
+    :param target_crs:
+        EPSG code of the target CRS
+    :param ncols:
+        number of columns of the source raster
+    :param nrows:
+        number of rows of the source raster
+    :param src_transform:
+        affine transformation of the source raster
+    :returns:
+        affine transformation, width and height of the target grid
+    """
+    return calculate_default_transform(
+        get_crs(src_epsg),
+        get_crs(target_crs),
+        ncols,
+        nrows,
+        *array_bounds(nrows, ncols, src_transform)
+    )
 
 
 def indicate_complete(output_dir_scene: Path) -> None:
@@ -74,8 +337,7 @@ def indicate_complete(output_dir_scene: Path) -> None:
     fpath_complete = output_dir_scene.joinpath(
         'complete.txt'
     )
-    with open(fpath_complete, 'w') as f:
-        f.write('complete')
+    fpath_complete.write_text('complete')
 
 
 def make_output_dir_scene(
@@ -93,38 +355,52 @@ def make_output_dir_scene(
         output directory.
     """
     output_dir_scene = output_dir.joinpath(f'{timestamp.date()}')
-    # make sure not to process an existing dataset again
-    if output_dir_scene.exists() and output_dir_scene.joinpath('complete'):
+    # make sure not to process an existing dataset again. Datasets
+    # are complete if the file written by `indicate_complete` exists.
+    # Incomplete datasets (e.g., from an interrupted run) are
+    # processed again
+    if output_dir_scene.joinpath('complete.txt').exists():
         raise SceneProcessedException(
             f'{output_dir_scene} already processed -> skipping')
-    output_dir_scene.mkdir()
+    output_dir_scene.mkdir(parents=True, exist_ok=True)
     return output_dir_scene
 
 
 def post_process_scene(
     scene: RasterCollection,
-    target_crs: int
+    target_crs: int,
+    num_threads: int = os.cpu_count() or 1,
+    warp_mem_limit: int = 512
 ) -> RasterCollection:
     """
     Post-process a satellite scene.
 
     This means:
     - reprojection to a target CRS
-    - calculation of the NDVI
+    - calculation of the NDVI (scaled to UINT16)
     - generation of a binary cloud mask
 
     :param scene:
         satellite scene
     :param target_crs:
         target CRS for reprojection
+    :param num_threads:
+        number of threads used for reprojection. All CPUs by default.
+    :param warp_mem_limit:
+        working memory used for reprojection in MB
     :returns:
         post-processed satellite scene
     """
     # reprojection to a target CRS
-    scene.reproject(target_crs=target_crs, inplace=True)
+    reproject_scene(
+        scene,
+        target_crs=target_crs,
+        num_threads=num_threads,
+        warp_mem_limit=warp_mem_limit
+    )
 
     # calculate the NDVI
-    scene.calc_si('ndvi', inplace=True)
+    calc_ndvi(scene)
 
     # Sentinel-2
     if isinstance(scene, Sentinel2):
@@ -135,18 +411,30 @@ def post_process_scene(
         # - 8: cloud medium probability
         # - 9: cloud high probability
         # Cirrus clouds (SCL class 10) are not treated as clouds
-        # as cirrus clouds can be corrected by the Sen2Cor processor
-        cloud_mask = scene.get_cloud_and_shadow_mask(cloud_classes=[3, 8, 9])
+        # as cirrus clouds can be corrected by the Sen2Cor processor.
+        # The classes are looked up in a single pass directly into
+        # a uint8 array.
+        scl = scene['SCL'].values
+        cloud_mask = _S2_CLOUD_LUT[
+            np.ma.getdata(scl).astype(np.uint8, copy=False)]
+        # pixels outside of the area of interest are not cloudy
+        if np.ma.isMaskedArray(scl):
+            cloud_mask[np.ma.getmaskarray(scl)] = 0
     elif isinstance(scene, Landsat):
         # generate a binary cloud mask from the pixel quality band.
         # Only bit 3 (cloud) is used here, as it is available for all
         # Landsat satellites (1 to 9).
-        cloud_mask = scene.get_cloud_and_shadow_mask(cloud_classes=[3])
+        cloud_mask = scene.get_cloud_and_shadow_mask(
+            cloud_classes=[3]).values
+        # cast to uint8. Boolean masks are re-interpreted as uint8
+        # without copying
+        if cloud_mask.dtype == bool:
+            cloud_mask = cloud_mask.view(np.uint8)
+        else:
+            cloud_mask = cloud_mask.astype(np.uint8)
 
-    # cast to uint8.
     # 0 = no cloud or outside of the area of interest
     # 1 = cloud or cloud shadow
-    cloud_mask = cloud_mask.values.astype(np.uint8)
     # add cloud mask to the scene
     scene.add_band(
         band_constructor=Band,
@@ -158,6 +446,184 @@ def post_process_scene(
     return scene
 
 
+def query_scenes(mapper: Mapper, cache_dir: Path) -> None:
+    """
+    Query the metadata of the scenes available for a `Mapper`.
+
+    The query results are cached in `cache_dir` keyed by a hash
+    of the query parameters so that repeated runs over the same
+    time period do not query the STAC API again. Only time periods
+    ending before today are cached as scenes might still be added
+    to the catalog for the current day. Queries for point geometries
+    are not cached as EOdal sets up the loading of point data while
+    querying. Cached results not used for `STAC_CACHE_MAX_AGE_DAYS`
+    days are removed when a new result is cached.
+
+    :param mapper:
+        Mapper object to query the scenes for
+    :param cache_dir:
+        directory where to cache the query results
+    """
+    mapper_configs = mapper.mapper_configs
+    if mapper_configs.feature.geometry.geom_type in ['Point', 'MultiPoint']:
+        mapper.query_scenes()
+        return
+
+    query = repr((
+        mapper_configs.collection,
+        mapper_configs.time_start.isoformat(),
+        mapper_configs.time_end.isoformat(),
+        mapper_configs.feature.epsg,
+        mapper_configs.feature.geometry.wkt,
+        [str(x) for x in mapper_configs.metadata_filters or []]
+    ))
+    key = hashlib.blake2b(query.encode(), digest_size=8).hexdigest()
+    fpath_cache = cache_dir.joinpath(f'{key}.pkl')
+
+    if fpath_cache.exists():
+        mapper.metadata = pd.read_pickle(fpath_cache)
+        # mark the cached result as recently used
+        os.utime(fpath_cache)
+        return
+
+    mapper.query_scenes()
+    if mapper_configs.time_end.date() < date.today():
+        cache_dir.mkdir(exist_ok=True)
+        mapper.metadata.to_pickle(fpath_cache)
+        # remove results not used for a while so that the cache
+        # does not grow without bounds
+        min_mtime = time.time() - STAC_CACHE_MAX_AGE_DAYS * 86400
+        with os.scandir(cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.pkl') and \
+                        entry.stat().st_mtime < min_mtime:
+                    os.remove(entry.path)
+
+
+def read_feature(fpath_feature: Path) -> Feature:
+    """
+    Read the area of interest from a vector file (e.g., GeoPackage
+    or Shapefile) and dissolve it into a single geometry.
+
+    Only the geometries are read, attributes are skipped.
+
+    :param fpath_feature:
+        path to the vector file
+    :returns:
+        Feature object of the area of interest
+    """
+    gdf = pyogrio.read_dataframe(fpath_feature, columns=[])
+    geoms = gpd.GeoSeries([unary_union(gdf.geometry.values)], crs=gdf.crs)
+    return Feature.from_geoseries(geoms)
+
+
+def reproject_scene(
+    scene: RasterCollection,
+    target_crs: int,
+    num_threads: int = os.cpu_count() or 1,
+    warp_mem_limit: int = 512
+) -> None:
+    """
+    Reproject all bands of a satellite scene into a target CRS
+    using nearest neighbor interpolation (in place).
+
+    In contrast to `RasterCollection.reproject` the bands are
+    warped one after another in their native data type. This
+    avoids the float64 copies of the band data EOdal creates
+    for reprojection and, thus, reduces the peak memory usage.
+    Bands already in the target CRS are not touched.
+
+    :param scene:
+        satellite scene
+    :param target_crs:
+        EPSG code of the target CRS
+    :param num_threads:
+        number of threads used by GDAL for warping. All CPUs
+        by default.
+    :param warp_mem_limit:
+        working memory of GDAL for warping in MB
+    """
+    dst_crs = get_crs(target_crs)
+    # buffer for warping the masks. The bands of a scene usually share
+    # the same grid so that the buffer can be reused across bands
+    mask_buffer = None
+    for band_name in scene.band_names:
+        band = scene[band_name]
+        # nothing to do if the band is already in the target CRS
+        if band.geo_info.epsg == target_crs:
+            continue
+        if band.is_masked_array:
+            src_data = band.values.data
+        else:
+            src_data = band.values
+        src_crs = get_crs(band.geo_info.epsg)
+        src_transform = band.transform
+
+        # determine the output grid
+        dst_transform, dst_width, dst_height = get_target_grid(
+            band.geo_info.epsg,
+            target_crs,
+            band.ncols,
+            band.nrows,
+            src_transform
+        )
+
+        # reproject the band data
+        dst_data = np.zeros((dst_height, dst_width), dtype=src_data.dtype)
+        reproject(
+            source=src_data,
+            destination=dst_data,
+            src_transform=src_transform,
+            src_crs=src_crs,
+            src_nodata=band.nodata,
+            dst_transform=dst_transform,
+            dst_crs=dst_crs,
+            dst_nodata=band.nodata,
+            resampling=Resampling.nearest,
+            num_threads=num_threads,
+            warp_mem_limit=warp_mem_limit
+        )
+
+        # reproject the mask separately. Pixels outside the
+        # footprint of the band and nodata pixels are masked
+        if band.is_masked_array:
+            if mask_buffer is None or \
+                    mask_buffer.shape != (dst_height, dst_width):
+                mask_buffer = np.empty(
+                    (dst_height, dst_width), dtype=np.uint8)
+            mask_buffer.fill(1)
+            # boolean masks can be viewed as uint8 without copying
+            reproject(
+                source=np.ma.getmaskarray(band.values).view(np.uint8),
+                destination=mask_buffer,
+                src_transform=src_transform,
+                src_crs=src_crs,
+                dst_transform=dst_transform,
+                dst_crs=dst_crs,
+                dst_nodata=1,
+                resampling=Resampling.nearest,
+                num_threads=num_threads,
+                warp_mem_limit=warp_mem_limit
+            )
+            dst_mask = mask_buffer.astype(bool)
+            if band.nodata is not None:
+                dst_mask |= dst_data == band.nodata
+            dst_data = np.ma.MaskedArray(
+                data=dst_data,
+                mask=dst_mask,
+                fill_value=band.values.fill_value
+            )
+
+        # replace the band in the scene
+        attrs = dict(band.__dict__)
+        attrs.update({
+            'values': dst_data,
+            'geo_info': GeoInfo.from_affine(
+                affine=dst_transform, epsg=target_crs)
+        })
+        scene.collection[band.band_name] = Band(**attrs)
+
+
 def set_latest_scene(
         output_dir: Path,
         timestamp: datetime
@@ -174,36 +640,17 @@ def set_latest_scene(
     # make sure the latest scene is never in the future
     if timestamp > datetime.now():
         timestamp = datetime.now()
-    with open(output_dir.joinpath('latest_scene'), 'w+') as f:
-        f.write(f'{timestamp.date()}')
-
-
-def scale_ndvi(scene: RasterCollection) -> None:
-    """
-    Scale the NDVI to UINT16 and add it to the scene.
-
-    :param scene:
-        satellite scene
-    """
-    ndvi_scaled = scene['ndvi'].values * 10000 + 10000  # scale to uint16
-    geo_info_ndvi = scene['ndvi'].geo_info
-    # delete the original NDVI
-    del scene['NDVI']
-    # and add the scaled NDVI
-    scene.add_band(
-        Band,
-        'ndvi',
-        ndvi_scaled.astype(np.uint16),
-        nodata=21000,
-        scale=0.0001,
-        offset=-1,
-        geo_info=geo_info_ndvi
-    )
+    # the file is replaced atomically so that an interrupted run
+    # never leaves behind an empty or truncated file
+    fpath_tmp = output_dir.joinpath('latest_scene.tmp')
+    fpath_tmp.write_text(f'{timestamp.date()}')
+    os.replace(fpath_tmp, output_dir.joinpath('latest_scene'))
 
 
 def write_cloudy_pixel_percentage(
     scene: RasterCollection,
-    fpath_cloudy_pixel_percentage: Path
+    fpath_cloudy_pixel_percentage: Path,
+    cloudy_pixel_percentage: float | None = None
 ) -> None:
     """
     Write the percentage of cloudy pixels in a satellite scene
@@ -214,19 +661,20 @@ def write_cloudy_pixel_percentage(
     :param fpath_cloudy_pixel_percentage:
         path to the file where the cloudy pixel percentage
         should be written to
+    :param cloudy_pixel_percentage:
+        cloudy pixel percentage if already calculated. Otherwise,
+        it is calculated from the scene.
     """
     # calculate the percentage of cloudy pixels
-    if isinstance(scene, Sentinel2):
-        cloudy_pixel_percentage = scene.get_cloudy_pixel_percentage(
-                cloud_classes=[3, 8, 9]
-            )
-    elif isinstance(scene, Landsat):
+    if cloudy_pixel_percentage is None:
+        cloudy_pixel_percentage = calc_cloudy_pixel_percentage(scene)
+    if cloudy_pixel_percentage is None:
         cloudy_pixel_percentage = -9999
         # TODO: implement cloud masking for Landsat
 
     # write the percentage of cloudy pixels to disk
-    with open(fpath_cloudy_pixel_percentage, 'w') as f:
-        f.write(f'{cloudy_pixel_percentage:.1f}')
+    fpath_cloudy_pixel_percentage.write_text(
+        f'{cloudy_pixel_percentage:.1f}')
 
 
 def write_scene_metadata(
@@ -245,9 +693,113 @@ def write_scene_metadata(
         'product_uri': scene.scene_properties.product_uri,
         'sensing_time': str(scene.scene_properties.sensing_time),
         'processing_level': scene.scene_properties.processing_level.value,
-        'eodal_version': eodal.__version__
+        'eodal_version': _EODAL_VERSION
     }
 
-    # save as YAML
-    with open(fpath_metadata, 'w+') as f:
-        yaml.dump(metadata, f, default_flow_style=False)
+    # save as YAML. The document is serialized (and encoded) in
+    # memory and written to disk in one go
+    fpath_metadata.write_bytes(
+        yaml.dump(
+            metadata,
+            Dumper=YamlDumper,
+            default_flow_style=False,
+            encoding='utf-8'
+        )
+    )
+
+
+def write_cog(
+    scene: RasterCollection,
+    band_selection: list[str],
+    fpath_raster: Path,
+    profile: dict = COG_PROFILE,
+    overview_resampling: str = 'average',
+    web_optimized: bool = False,
+    num_threads: int | None = None
+) -> None:
+    """
+    Write bands of a satellite scene to a cloud-optimized GeoTIFF.
+
+    Works like `RasterCollection.to_rasterio(as_cog=True)` but
+    allows to pass the creation options of the output file and
+    the resampling method of the internal overviews.
+
+    :param scene:
+        satellite scene
+    :param band_selection:
+        bands to write to the output file
+    :param fpath_raster:
+        path to the output file (existing files are overwritten)
+    :param profile:
+        creation options of the cloud-optimized GeoTIFF
+    :param overview_resampling:
+        resampling method for building the internal overviews.
+        'average' by default, use 'nearest' for categorical data.
+    :param web_optimized:
+        if True, the internal tiles and overviews of the output file
+        are aligned to the GoogleMapsCompatible (web mercator) tiling
+        scheme so that tile servers can read them without reprojection.
+        The pixels are snapped (nearest neighbor) to the grid of the
+        closest zoom level.
+    :param num_threads:
+        number of threads GDAL may use for compressing the output
+        file and building its overviews. Overrides `GDAL_NUM_THREADS`
+        set as environment variable (see `get_gdal_env`). If None
+        (default), the number of threads is taken from the GDAL
+        configuration.
+    """
+    # limit the number of threads used for compression
+    gdal_env = get_gdal_env(COG_ENV)
+    if num_threads is not None:
+        gdal_env['GDAL_NUM_THREADS'] = num_threads
+        profile = {**profile, 'num_threads': num_threads}
+
+    # look up the bands only once
+    bands = [scene[band_name] for band_name in band_selection]
+    # all bands are cast to the highest data type in the selection
+    highest_dtype = get_highest_dtype([band.values.dtype for band in bands])
+    meta = deepcopy(bands[0].meta)
+    # the temporary dataset is band interleaved so that each band
+    # is written in one go without updating blocks shared with the
+    # other bands. It is tiled with the block size of the output so
+    # that each output block is read from exactly one source block
+    meta.update({
+        'driver': 'GTiff',
+        'count': len(band_selection),
+        'dtype': str(highest_dtype),
+        'nodata': bands[0].nodata,
+        'interleave': 'band',
+        'tiled': True,
+        'blockxsize': profile['blockxsize'],
+        'blockysize': profile['blockysize']
+    })
+
+    # the in-memory file and the COG are written within the same
+    # GDAL environment
+    with Env(**gdal_env):
+        with MemoryFile() as memfile:
+            with memfile.open(**meta) as mem:
+                # set scales, offsets and band names
+                mem.scales = [band.scale for band in bands]
+                mem.offsets = [band.offset for band in bands]
+                for idx, (band_name, band) in enumerate(
+                        zip(band_selection, bands)):
+                    mem.set_band_description(idx + 1, band_name)
+                    # the bands are kept in their native integer data type
+                    # (no scaling applied) so casting is only required if
+                    # data types differ within the selection
+                    mem.write(
+                        band.values.astype(highest_dtype, copy=False),
+                        idx + 1
+                    )
+
+                # write the COG
+                cog_translate(
+                    mem,
+                    fpath_raster,
+                    dict(profile),
+                    overview_resampling=overview_resampling,
+                    web_optimized=web_optimized,
+                    in_memory=True,
+                    quiet=True
+                )
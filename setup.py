@@ -17,6 +17,7 @@ setup(
     description='A tool to download satellite data, pre-process it and store it as cloud-optimized GeoTIFFs based on EOdal.',
     install_requires=[
         'eodal==0.2.4',
+        'pyogrio',
         'rio-cogeo'
     ],
 )
@@ -19,13 +19,19 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import annotations
 
+import os
 import pytest
-import geopandas as gpd
+import rasterio as rio
 import shutil
+import threading
+import time
 import yaml
 
+from concurrent.futures import ThreadPoolExecutor
+from eodal.core.band import Band
 from eodal.core.raster import RasterCollection
 from eodal.mapper.feature import Feature
+from functools import partial
 from pathlib import Path
 
 from eodal_basetiffs.constants import (
@@ -33,20 +39,70 @@ from eodal_basetiffs.constants import (
     LandsatC2L2Constants,
     Sentinel2Constants)
 from eodal_basetiffs.main import monitor_folder
+from eodal_basetiffs.utils import read_feature
 
+# use the C implementation of the YAML loader (libyaml) if available
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
-@pytest.fixture
+
+@pytest.fixture(scope='session')
 def get_data_dir() -> Path:
     return Path(__file__).parents[1].joinpath('data')
 
 
-@pytest.fixture
+@pytest.fixture(scope='session')
 def get_feature(get_data_dir) -> Feature:
     data_dir = get_data_dir
     fpath_feature = data_dir.joinpath('test_region.gpkg')
-    feature = Feature.from_geoseries(
-        gpd.read_file(fpath_feature).dissolve().geometry)
-    return feature
+    return read_feature(fpath_feature)
+
+
+# threads deleting the outputs of previous runs in the background
+CLEANUP_THREADS: list[threading.Thread] = []
+
+
+@pytest.fixture(scope='session', autouse=True)
+def join_cleanup_threads():
+    # wait for the background deletions to finish before the
+    # interpreter exits so that no partially deleted directories
+    # are left behind
+    yield
+    for thread in CLEANUP_THREADS:
+        thread.join()
+
+
+def remove_dirs(dirs: list[Path]) -> None:
+    for dir_to_remove in dirs:
+        shutil.rmtree(dir_to_remove, ignore_errors=True)
+
+
+def make_clean_output_dir(output_dir: Path) -> None:
+    # outputs of a previous run are moved out of the way (a single
+    # rename) and deleted in the background while the test runs.
+    # Left-overs of interrupted runs are deleted as well
+    dirs_to_remove = list(
+        output_dir.parent.glob(f'{output_dir.name}.gc-*'))
+    if output_dir.exists():
+        scratch_dir = output_dir.with_name(
+            f'{output_dir.name}.gc-{os.getpid()}-{time.time_ns()}')
+        os.replace(output_dir, scratch_dir)
+        dirs_to_remove.append(scratch_dir)
+    if dirs_to_remove:
+        thread = threading.Thread(
+            target=remove_dirs, args=(dirs_to_remove,), daemon=True)
+        thread.start()
+        CLEANUP_THREADS.append(thread)
+    output_dir.mkdir()
+
+
+def get_scaled_min_max(band: Band) -> tuple[float, float]:
+    # scale only the minimum and maximum instead of the whole band
+    values = band.values
+    scale, offset = band.scale, band.offset
+    return values.min() * scale + offset, values.max() * scale + offset
 
 
 def validate_rgb(fpath: Path) -> None:
@@ -55,13 +111,14 @@ def validate_rgb(fpath: Path) -> None:
     assert rc.band_names == ['red', 'green', 'blue']
 
     for band_name in rc.band_names:
-        assert rc[band_name].scale == 0.0001
-        assert rc[band_name].values.dtype == 'uint16'
-        assert rc[band_name].nodata == 0
-        assert rc[band_name].geo_info.epsg == 3857
-        scaled = rc[band_name].scale_data()
-        assert scaled.values.min() >= -0.1
-        assert scaled.values.max() <= 1.6
+        band = rc[band_name]
+        assert band.scale == 0.0001
+        assert band.values.dtype == 'uint16'
+        assert band.nodata == 0
+        assert band.geo_info.epsg == 3857
+        scaled_min, scaled_max = get_scaled_min_max(band)
+        assert scaled_min >= -0.1
+        assert scaled_max <= 1.6
 
 
 def validate_rgb_landsat(fpath: Path) -> None:
@@ -70,13 +127,14 @@ def validate_rgb_landsat(fpath: Path) -> None:
     assert rc.band_names == ['red', 'green', 'blue']
 
     for band_name in rc.band_names:
-        assert rc[band_name].scale == 1e-5
-        assert rc[band_name].values.dtype == 'uint16'
-        assert rc[band_name].nodata == 0
-        assert rc[band_name].geo_info.epsg == 3857
-        scaled = rc[band_name].scale_data()
-        assert scaled.values.min() >= 0
-        assert scaled.values.max() <= 1
+        band = rc[band_name]
+        assert band.scale == 1e-5
+        assert band.values.dtype == 'uint16'
+        assert band.nodata == 0
+        assert band.geo_info.epsg == 3857
+        scaled_min, scaled_max = get_scaled_min_max(band)
+        assert scaled_min >= 0
+        assert scaled_max <= 1
 
 
 def validate_fcir(fpath: Path) -> None:
@@ -85,13 +143,14 @@ def validate_fcir(fpath: Path) -> None:
     assert rc.band_names == ['nir_1', 'red', 'green']
 
     for band_name in rc.band_names:
-        assert rc[band_name].scale == 0.0001
-        assert rc[band_name].values.dtype == 'uint16'
-        assert rc[band_name].nodata == 0
-        assert rc[band_name].geo_info.epsg == 3857
-        scaled = rc[band_name].scale_data()
-        assert scaled.values.min() >= -0.1
-        assert scaled.values.max() <= 1.6
+        band = rc[band_name]
+        assert band.scale == 0.0001
+        assert band.values.dtype == 'uint16'
+        assert band.nodata == 0
+        assert band.geo_info.epsg == 3857
+        scaled_min, scaled_max = get_scaled_min_max(band)
+        assert scaled_min >= -0.1
+        assert scaled_max <= 1.6
 
 
 def validate_fcir_landsat_l2(fpath: Path) -> None:
@@ -100,14 +159,15 @@ def validate_fcir_landsat_l2(fpath: Path) -> None:
     assert rc.band_names  == ['nir08', 'red', 'green']
 
     for band_name in rc.band_names:
-        assert rc[band_name].scale == 1e-5
-        assert rc[band_name].offset == 0
-        assert rc[band_name].values.dtype == 'uint16'
-        assert rc[band_name].nodata == 0
-        assert rc[band_name].geo_info.epsg == 3857
-        scaled = rc[band_name].scale_data()
-        assert scaled.values.min() >= 0.
-        assert scaled.values.max() <= 1.
+        band = rc[band_name]
+        assert band.scale == 1e-5
+        assert band.offset == 0
+        assert band.values.dtype == 'uint16'
+        assert band.nodata == 0
+        assert band.geo_info.epsg == 3857
+        scaled_min, scaled_max = get_scaled_min_max(band)
+        assert scaled_min >= 0.
+        assert scaled_max <= 1.
 
 
 def validate_fcir_landsat_l1(fpath: Path) -> None:
@@ -117,45 +177,78 @@ def validate_fcir_landsat_l1(fpath: Path) -> None:
 
     # the level 1 is in 8bit!
     for band_name in rc.band_names:
-        assert rc[band_name].scale == 1.0
-        assert rc[band_name].values.dtype == 'uint8'
-        assert rc[band_name].nodata == 0
-        assert rc[band_name].geo_info.epsg == 3857
-        scaled = rc[band_name].scale_data()
-        assert scaled.values.min() >= 0
-        assert scaled.values.max() <= 255
+        band = rc[band_name]
+        assert band.scale == 1.0
+        assert band.values.dtype == 'uint8'
+        assert band.nodata == 0
+        assert band.geo_info.epsg == 3857
+        scaled_min, scaled_max = get_scaled_min_max(band)
+        assert scaled_min >= 0
+        assert scaled_max <= 255
 
 
 def validate_ndvi(fpath: Path) -> None:
-    rc = RasterCollection.from_multi_band_raster(fpath)
-    assert len(rc) == 1
-    assert rc.band_names == ['ndvi']
-    assert rc['ndvi'].values.dtype == 'uint16'
-    assert rc['ndvi'].nodata == 21000
-    assert rc['ndvi'].scale == 0.0001
-    assert rc['ndvi'].offset == -1
+    # only the file header is checked so the pixels are not read
+    with rio.open(fpath) as src:
+        assert src.count == 1
+        assert src.descriptions == ('ndvi',)
+        assert src.dtypes == ('uint16',)
+        assert src.nodatavals == (21000,)
+        assert src.scales == (0.0001,)
+        assert src.offsets == (-1,)
 
 
 def validate_yaml(fpath: Path) -> None:
     # check if the yaml file is valid and contains the
     # required fields
     with open(fpath, 'r') as f:
-        yaml_dict = yaml.load(f, Loader=yaml.FullLoader)
+        yaml_dict = yaml.load(f, Loader=YamlLoader)
         assert 'product_uri' in yaml_dict
         assert 'sensing_time' in yaml_dict
         assert 'eodal_version' in yaml_dict
         assert 'processing_level' in yaml_dict
 
 
+def validate_scene_outputs(
+    scene_dir: Path,
+    scene: str,
+    has_rgb: bool = True
+) -> None:
+    # list the scene directory once instead of checking every
+    # output file separately
+    assert scene_dir.exists()
+    existing = set(os.listdir(scene_dir))
+    for suffix in (
+        '_cloud_mask.tif',
+        '_ndvi.tif',
+        '_fcir.tif',
+        '_cloudy_pixel_percentage.txt',
+        '_metadata.yaml'
+    ):
+        assert f'{scene}{suffix}' in existing, f'{scene}{suffix}'
+    assert (f'{scene}_rgb.tif' in existing) == has_rgb
+    assert 'complete.txt' in existing
+
+
+def validate_landsat_l2_scene(output_dir: Path, scene: str) -> None:
+    scene_dir = output_dir.joinpath(scene)
+    # ensure all outputs exist
+    validate_scene_outputs(scene_dir, scene)
+
+    # validate output
+    validate_fcir_landsat_l2(scene_dir.joinpath(f'{scene}_fcir.tif'))
+    validate_rgb_landsat(scene_dir.joinpath(f'{scene}_rgb.tif'))
+    validate_ndvi(scene_dir.joinpath(f'{scene}_ndvi.tif'))
+    validate_yaml(scene_dir.joinpath(f'{scene}_metadata.yaml'))
+
+
 def test_sentinel2(get_data_dir, get_feature):
 
     constants = Sentinel2Constants
     feature = get_feature
     output_dir = get_data_dir.joinpath('sentinel2')
     # ensure a "clean" start
-    if output_dir.exists():
-        shutil.rmtree(output_dir)
-    output_dir.mkdir()
+    make_clean_output_dir(output_dir)
 
     monitor_folder(
         constants=constants,
@@ -166,14 +259,7 @@ def test_sentinel2(get_data_dir, get_feature):
 
     scene_dir = output_dir.joinpath('2017-01-07')
     # ensure all outputs exist
-    assert scene_dir.exists()
-    assert scene_dir.joinpath('2017-01-07_cloud_mask.tif').exists()
-    assert scene_dir.joinpath('2017-01-07_ndvi.tif').exists()
-    assert scene_dir.joinpath('2017-01-07_rgb.tif').exists()
-    assert scene_dir.joinpath('2017-01-07_fcir.tif').exists()
-    assert scene_dir.joinpath('complete.txt').exists()
-    assert scene_dir.joinpath('2017-01-07_cloudy_pixel_percentage.txt').exists()
-    assert scene_dir.joinpath('2017-01-07_metadata.yaml').exists()
+    validate_scene_outputs(scene_dir, '2017-01-07')
 
     # validate output
     validate_fcir(scene_dir.joinpath('2017-01-07_fcir.tif'))
@@ -181,9 +267,8 @@ def test_sentinel2(get_data_dir, get_feature):
     validate_ndvi(scene_dir.joinpath('2017-01-07_ndvi.tif'))
     validate_yaml(scene_dir.joinpath('2017-01-07_metadata.yaml'))
     # read the cloudy pixel percentage file and assure it is correct
-    with open(
-        scene_dir.joinpath('2017-01-07_cloudy_pixel_percentage.txt'),'r') as f:
-        cloud_cover = float(f.read())
+    cloud_cover = float(scene_dir.joinpath(
+        '2017-01-07_cloudy_pixel_percentage.txt').read_bytes())
     assert cloud_cover == 26.5
 
 
@@ -193,9 +278,7 @@ def test_landsat_c2l1(get_data_dir, get_feature):
     feature = get_feature
     output_dir = get_data_dir.joinpath('landsat-l1')
     # ensure a "clean" start
-    if output_dir.exists():
-        shutil.rmtree(output_dir)
-    output_dir.mkdir()
+    make_clean_output_dir(output_dir)
 
     monitor_folder(
         constants=constants,
@@ -206,15 +289,8 @@ def test_landsat_c2l1(get_data_dir, get_feature):
 
     scene_dir = output_dir.joinpath('1972-09-20')
     # ensure all outputs exist
-    assert scene_dir.exists()
-
-    assert scene_dir.joinpath('1972-09-20_cloud_mask.tif').exists()
-    assert scene_dir.joinpath('1972-09-20_ndvi.tif').exists()
-    assert not scene_dir.joinpath('1972-09-20_rgb.tif').exists()
-    assert scene_dir.joinpath('1972-09-20_fcir.tif').exists()
-    assert scene_dir.joinpath('complete.txt').exists()
-    assert scene_dir.joinpath('1972-09-20_cloudy_pixel_percentage.txt').exists()
-    assert scene_dir.joinpath('1972-09-20_metadata.yaml').exists()
+    # (no RGB for Landsat 1-4 as they do not have a blue band)
+    validate_scene_outputs(scene_dir, '1972-09-20', has_rgb=False)
 
     # validate output
     validate_fcir_landsat_l1(scene_dir.joinpath('1972-09-20_fcir.tif'))
@@ -228,15 +304,16 @@ def test_landsat_c2l2(get_data_dir, get_feature):
     feature = get_feature
     output_dir = get_data_dir.joinpath('landsat-l2')
     # ensure a "clean" start
-    if output_dir.exists():
-        shutil.rmtree(output_dir)
-    output_dir.mkdir()
+    make_clean_output_dir(output_dir)
 
     monitor_folder(
         constants=constants,
         feature=feature,
         folder_to_monitor=output_dir,
-        temporal_increment_days=60)
+        temporal_increment_days=60,
+        # process the scenes in a process pool to cover the parallel
+        # path (pickling of the scenes, in-order finalization)
+        n_workers=2)
 
     scenes = [
         '2016-01-05',
@@ -251,24 +328,11 @@ def test_landsat_c2l2(get_data_dir, get_feature):
         '2016-02-22',
         '2016-03-01'
     ]
-    for scene in scenes:
-        scene_dir = output_dir.joinpath(scene)
-        # ensure all outputs exist
-        assert scene_dir.exists()
-        assert scene_dir.joinpath(f'{scene}_cloud_mask.tif').exists()
-        assert scene_dir.joinpath(f'{scene}_ndvi.tif').exists()
-        assert scene_dir.joinpath(f'{scene}_rgb.tif').exists()
-        assert scene_dir.joinpath(f'{scene}_fcir.tif').exists()
-        assert scene_dir.joinpath('complete.txt').exists()
-        assert scene_dir.joinpath(
-            f'{scene}_cloudy_pixel_percentage.txt').exists()
-        assert scene_dir.joinpath(f'{scene}_metadata.yaml').exists()
-
-        # validate output
-        validate_fcir_landsat_l2(scene_dir.joinpath(f'{scene}_fcir.tif'))
-        validate_rgb_landsat(scene_dir.joinpath(f'{scene}_rgb.tif'))
-        validate_ndvi(scene_dir.joinpath(f'{scene}_ndvi.tif'))
-        validate_yaml(scene_dir.joinpath(f'{scene}_metadata.yaml'))
+    # the scenes are independent so they are validated concurrently.
+    # Exhausting the results re-raises the first failed assertion
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(
+            partial(validate_landsat_l2_scene, output_dir), scenes))
 
 
 # TODO: Add test for cli function to test the full argparser
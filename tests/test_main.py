@@ -0,0 +1,80 @@
+"""
+Tests for `eodal_basetiffs.main` not requiring network access.
+
+Copyright (C) 2023 Terensis
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+import os
+
+from datetime import datetime
+from eodal.core.band import Band, GeoInfo
+from eodal.core.raster import SceneProperties
+from eodal.core.sensors import Sentinel2
+from eodal.utils.constants import ProcessingLevels
+
+from eodal_basetiffs.constants import Sentinel2Constants
+from eodal_basetiffs.main import _finalize_scene, _run_inline, process_scene
+from eodal_basetiffs.utils import get_latest_scene, make_output_dir_scene
+
+
+def test_process_scene_too_cloudy(tmp_path):
+    timestamp = datetime(2017, 1, 7, 10, 27, 31)
+    # two out of three valid pixels (SCL class 0 is nodata) are cloudy
+    scl = np.array([[4, 8], [9, 0]], dtype=np.uint8)
+    scene = Sentinel2(
+        band_constructor=Band,
+        band_name='SCL',
+        values=scl,
+        geo_info=GeoInfo(
+            epsg=32632, ulx=600000, uly=5200000, pixres_x=20, pixres_y=-20),
+        scene_properties=SceneProperties(
+            acquisition_time=timestamp,
+            platform='S2A',
+            sensor='MSI',
+            processing_level=ProcessingLevels.L2A,
+            product_uri='S2A_MSIL2A_20170107T102731')
+    )
+    # the sensing time is set by the Mapper when loading scenes
+    scene.scene_properties.sensing_time = timestamp
+    output_dir_scene = make_output_dir_scene(tmp_path, timestamp)
+
+    # the scene is handled the same way as by `fetch_data` (n_workers=1)
+    future = _run_inline(
+        process_scene,
+        timestamp=timestamp,
+        scene=scene,
+        output_dir_scene=output_dir_scene,
+        target_crs=3857,
+        constants=Sentinel2Constants,
+        max_cloudy_pixel_percentage=0,
+    )
+    assert future.result()
+    _finalize_scene(tmp_path, timestamp, output_dir_scene, future)
+
+    # no GeoTIFFs are written but the scene is complete
+    assert set(os.listdir(output_dir_scene)) == {
+        '2017-01-07_cloudy_pixel_percentage.txt',
+        '2017-01-07_metadata.yaml',
+        'complete.txt'
+    }
+    assert output_dir_scene.joinpath(
+        '2017-01-07_cloudy_pixel_percentage.txt').read_text() == '66.7'
+    # the latest scene advances to the skipped scene
+    assert get_latest_scene(tmp_path, constants=Sentinel2Constants) == \
+        datetime(2017, 1, 7)
@@ -0,0 +1,245 @@
+"""
+Tests for `eodal_basetiffs.utils` not requiring network access.
+
+Copyright (C) 2023 Terensis
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+import geopandas as gpd
+import numpy as np
+import os
+import pytest
+
+from datetime import datetime
+from eodal.core.band import Band, GeoInfo
+from eodal.core.raster import RasterCollection
+from eodal.core.sensors import Sentinel2
+from eodal.mapper.feature import Feature
+from eodal.mapper.mapper import Mapper, MapperConfigs
+from shapely.geometry import box, Point
+
+from eodal_basetiffs.constants import Sentinel2Constants
+from eodal_basetiffs.utils import (
+    calc_cloudy_pixel_percentage,
+    calc_ndvi,
+    filter_processed_scenes,
+    get_latest_scene,
+    indicate_complete,
+    make_output_dir_scene,
+    query_scenes,
+    SceneProcessedException,
+    set_latest_scene)
+
+
+def make_scene(red: np.ndarray, nir: np.ndarray) -> RasterCollection:
+    # small in-memory scene with a red and a (Landsat) nir band
+    geo_info = GeoInfo(
+        epsg=32632, ulx=600000, uly=5200000, pixres_x=10, pixres_y=-10)
+    scene = RasterCollection(
+        band_constructor=Band,
+        band_name='red',
+        values=red,
+        geo_info=geo_info
+    )
+    scene.add_band(
+        band_constructor=Band,
+        band_name='nir08',
+        values=nir,
+        geo_info=geo_info
+    )
+    return scene
+
+
+def test_calc_ndvi():
+    # pixels: zero denominator, NDVI 0.5, -0.5, 1, 1/7 (rounded),
+    # NDVI 3 and -3 (clipped to 1 and -1) and a masked pixel
+    red = np.array([[0, 100, 300, 0, 3, -50, 100, 100]], dtype=np.int16)
+    nir = np.array([[0, 300, 100, 100, 4, 100, -50, 300]], dtype=np.int16)
+    mask = np.array([[0, 0, 0, 0, 0, 0, 0, 1]], dtype=bool)
+    expected = np.array(
+        [[21000, 15000, 5000, 20000, 11429, 20000, 0, 21000]],
+        dtype=np.uint16)
+    # the rows span several blocks of the NDVI calculation
+    n_rows = 1030
+    red = np.ma.MaskedArray(
+        data=np.repeat(red, n_rows, axis=0),
+        mask=np.repeat(mask, n_rows, axis=0))
+    nir = np.repeat(nir, n_rows, axis=0)
+    expected = np.repeat(expected, n_rows, axis=0)
+
+    scene = make_scene(red, nir)
+    calc_ndvi(scene)
+
+    ndvi = scene['ndvi']
+    assert ndvi.values.dtype == 'uint16'
+    assert ndvi.nodata == 21000
+    assert ndvi.scale == 0.0001
+    assert ndvi.offset == -1
+    np.testing.assert_array_equal(np.ma.getdata(ndvi.values), expected)
+    # masked pixels and pixels without a valid NDVI are masked
+    np.testing.assert_array_equal(
+        np.ma.getmaskarray(ndvi.values), expected == 21000)
+
+
+def test_calc_ndvi_unmasked():
+    # unmasked unsigned inputs (nir smaller than red must not wrap)
+    red = np.array([[0, 100, 300]], dtype=np.uint16)
+    nir = np.array([[0, 300, 100]], dtype=np.uint16)
+    scene = make_scene(red, nir)
+    calc_ndvi(scene)
+
+    ndvi = scene['ndvi'].values
+    assert ndvi.dtype == 'uint16'
+    np.testing.assert_array_equal(
+        np.ma.getdata(ndvi), [[21000, 15000, 5000]])
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.int16, np.float32])
+def test_calc_cloudy_pixel_percentage(dtype):
+    # two out of three valid pixels (SCL class 0 is nodata) are cloudy.
+    # The last pixel is outside of the area of interest
+    scl = np.ma.MaskedArray(
+        data=np.array([[4, 8, 9, 0, 3]], dtype=dtype),
+        mask=np.array([[0, 0, 0, 0, 1]], dtype=bool))
+    scene = Sentinel2(
+        band_constructor=Band,
+        band_name='SCL',
+        values=scl,
+        geo_info=GeoInfo(
+            epsg=32632, ulx=600000, uly=5200000, pixres_x=20, pixres_y=-20)
+    )
+    assert calc_cloudy_pixel_percentage(scene) == pytest.approx(200 / 3)
+    # no cloudy pixel percentage for other platforms
+    assert calc_cloudy_pixel_percentage(make_scene(scl, scl)) is None
+
+
+def test_make_output_dir_scene(tmp_path):
+    timestamp = datetime(2017, 1, 7, 10, 27, 31)
+    output_dir_scene = make_output_dir_scene(tmp_path, timestamp)
+    assert output_dir_scene == tmp_path.joinpath('2017-01-07')
+    assert output_dir_scene.is_dir()
+
+    # incomplete scenes (e.g., from an interrupted run) are processed
+    # again in the existing directory
+    output_dir_scene.joinpath('2017-01-07_rgb.tif').touch()
+    assert make_output_dir_scene(tmp_path, timestamp) == output_dir_scene
+
+    # completed scenes are skipped
+    indicate_complete(output_dir_scene)
+    with pytest.raises(SceneProcessedException):
+        make_output_dir_scene(tmp_path, timestamp)
+
+
+def test_latest_scene(tmp_path):
+    # without a latest_scene file the start date of the platform is used
+    assert get_latest_scene(tmp_path, constants=Sentinel2Constants) == \
+        Sentinel2Constants.START_DATE
+
+    # a left-over temporary file of an interrupted run is replaced
+    tmp_path.joinpath('latest_scene.tmp').write_text('2017-0')
+    set_latest_scene(tmp_path, timestamp=datetime(2017, 1, 7, 10, 27, 31))
+    assert not tmp_path.joinpath('latest_scene.tmp').exists()
+    assert tmp_path.joinpath('latest_scene').read_text() == '2017-01-07'
+    assert get_latest_scene(tmp_path, constants=Sentinel2Constants) == \
+        datetime(2017, 1, 7)
+
+    # the latest scene is replaced and never set to the future
+    set_latest_scene(tmp_path, timestamp=datetime(2999, 1, 1))
+    assert get_latest_scene(
+        tmp_path, constants=Sentinel2Constants).date() == \
+        datetime.now().date()
+
+
+def test_filter_processed_scenes(tmp_path):
+    feature = Feature(
+        name='aoi', geometry=box(8.5, 47.3, 8.6, 47.4), epsg=4326)
+    mapper = Mapper(MapperConfigs(
+        collection=Sentinel2Constants.COLLECTION,
+        feature=feature,
+        time_start=datetime(2017, 1, 1),
+        time_end=datetime(2017, 1, 31)))
+    sensing_times = [
+        datetime(2017, 1, 7, 10, 27, 31),
+        datetime(2017, 1, 10, 10, 37, 12),
+        datetime(2017, 1, 14, 10, 27, 1)
+    ]
+    mapper.metadata = gpd.GeoDataFrame(
+        {
+            'product_uri': [f'scene_{idx}' for idx in range(3)],
+            'sensing_time': sensing_times
+        },
+        geometry=[feature.geometry] * 3,
+        crs=4326
+    )
+
+    # 2017-01-07 is complete, 2017-01-10 is incomplete (interrupted
+    # run) and 2017-01-14 has not been processed at all
+    indicate_complete(make_output_dir_scene(tmp_path, sensing_times[0]))
+    make_output_dir_scene(tmp_path, sensing_times[1])
+    # files in the output directory are ignored
+    tmp_path.joinpath('latest_scene').write_text('2017-01-07')
+
+    filter_processed_scenes(mapper, output_dir=tmp_path)
+    assert mapper.metadata['product_uri'].tolist() == [
+        'scene_1', 'scene_2']
+
+    # queries without results return metadata without any columns
+    mapper.metadata = gpd.GeoDataFrame()
+    filter_processed_scenes(mapper, output_dir=tmp_path)
+    assert mapper.metadata.empty
+
+
+def make_counting_mapper(geometry) -> Mapper:
+    # Mapper counting its STAC queries without accessing the network
+    mapper = Mapper(MapperConfigs(
+        collection=Sentinel2Constants.COLLECTION,
+        feature=Feature(name='aoi', geometry=geometry, epsg=4326),
+        time_start=datetime(2017, 1, 1),
+        time_end=datetime(2017, 1, 31)))
+    mapper.n_queries = 0
+
+    def count_query():
+        mapper.n_queries += 1
+        mapper.metadata = gpd.GeoDataFrame()
+
+    mapper.query_scenes = count_query
+    return mapper
+
+
+def test_query_scenes_cache(tmp_path):
+    cache_dir = tmp_path.joinpath('.stac_cache')
+    cache_dir.mkdir()
+    # results not used for a long time are removed from the cache
+    fpath_stale = cache_dir.joinpath('stale.pkl')
+    fpath_stale.touch()
+    os.utime(fpath_stale, (0, 0))
+
+    # the second query for the same time period is read from the cache
+    for _ in range(2):
+        mapper = make_counting_mapper(box(8.5, 47.3, 8.6, 47.4))
+        query_scenes(mapper, cache_dir=cache_dir)
+    assert mapper.n_queries == 0
+    assert mapper.metadata.empty
+    assert len(os.listdir(cache_dir)) == 1
+    assert not fpath_stale.exists()
+
+    # queries for point geometries are never cached
+    for _ in range(2):
+        mapper = make_counting_mapper(Point(8.5, 47.3))
+        query_scenes(mapper, cache_dir=cache_dir)
+        assert mapper.n_queries == 1
+    assert len(os.listdir(cache_dir)) == 1